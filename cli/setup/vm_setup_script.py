@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-"""
+r"""
 VM Setup Script for Ralph-Inferno Project
 
 Converts the original bash setup script to Python for better maintainability
@@ -17,6 +17,7 @@ TODO:
     export GIT_EMAIL='your-email@users.noreply.github.com'
     export OPENROUTER_API_KEY='your-actual-api-key'
     export GITHUB_REPO='https://github.com/sandstream/ralph-inferno.git'  # optional
+    export NODESOURCE_SETUP_SHA256='<sha256 of setup_20.x>'  # optional, pins the NodeSource script
 
     # Run the script
     chmod +x vm_setup.py
@@ -27,12 +28,23 @@ TODO:
     C:\Users\<username>\.ralph\.claude\commands
 """
 
+import shlex
 import subprocess
 import sys
 import os
-from typing import Optional, Union, List
+from functools import lru_cache
+from typing import Optional, Union, List, Tuple
 from pathlib import Path
 
+# A single command: a shell string, or an argument list that gets quoted
+Command = Union[str, List[str]]
+
+
+@lru_cache(maxsize=64)
+def _tokenize(command: str) -> Tuple[str, ...]:
+    """Split a command line into arguments using shell quoting rules (cached)."""
+    return tuple(shlex.split(command))
+
 
 class CommandLineInterface:
     """Utility class for running shell commands."""
@@ -76,8 +88,9 @@ class CommandLineInterface:
             return result
         except subprocess.CalledProcessError as e:
             print(f"Command failed with exit code {e.returncode}", file=sys.stderr)
-            print(f"stdout: {e.stdout}", file=sys.stderr)
-            print(f"stderr: {e.stderr}", file=sys.stderr)
+            if capture:  # Otherwise the output already went to the terminal
+                print(f"stdout: {e.stdout}", file=sys.stderr)
+                print(f"stderr: {e.stderr}", file=sys.stderr)
             raise
         except subprocess.TimeoutExpired as e:
             print(f"Command timed out after {timeout} seconds", file=sys.stderr)
@@ -85,7 +98,27 @@ class CommandLineInterface:
         except Exception as e:
             print(f"Unexpected error: {e}", file=sys.stderr)
             raise
-            
+
+    @staticmethod
+    def join_script(commands: List[Command]) -> str:
+        """Join commands into a script, quoting argument-list commands."""
+        return '\n'.join(
+            c if isinstance(c, str) else shlex.join(c) for c in commands
+        )
+
+    @staticmethod
+    def run_script(commands: List[Command], **kwargs) -> subprocess.CompletedProcess:
+        """
+        Run a batch of commands in a single `bash -e -c` process.
+
+        One fork/exec for the whole batch instead of one per command; the
+        first failing command stops the script. The script is passed as an
+        argument rather than on stdin so commands that read stdin (sudo,
+        npx) can't swallow the rest of it. Output goes straight to the
+        terminal so progress shows while long steps run.
+        """
+        script = CommandLineInterface.join_script(commands)
+        return CommandLineInterface.run(['bash', '-e', '-c', script], capture=False, **kwargs)
 
     @staticmethod
     def print_box(message: str, boxchar: str = '-'):
@@ -117,12 +150,25 @@ def title(message: str, divider_char: str = '🔥'):
 
 class VMSetup:
     """Main setup class for configuring VM for Ralph-Inferno."""
+
+    # Installed together in a single apt-get run (see install_packages)
+    APT_PACKAGES = ['nodejs', 'gh']
+
+    # NodeSource setup script: downloaded once, skipped when its apt source already exists
+    NODESOURCE_SETUP_URL = 'https://deb.nodesource.com/setup_20.x'
+    NODESOURCE_SETUP_CACHE = Path.home() / '.cache' / 'ralph-inferno' / 'nodesource_setup_20.x.sh'
+    NODESOURCE_APT_SOURCE = '/etc/apt/sources.list.d/nodesource.list'
+
+    # Only the browsers the project's E2E tests use
+    PLAYWRIGHT_BROWSERS = ['chromium']
     
-    def __init__(self, github_repo: str, email: str, api_key: str, project_repo: str = ""):
+    def __init__(self, github_repo: str, email: str, api_key: str, project_repo: str = "",
+                 nodesource_sha256: str = ""):
         self.github_repo = github_repo
         self.project_repo = project_repo
         self.email = email
         self.api_key = api_key
+        self.nodesource_sha256 = nodesource_sha256
         self.cli = CommandLineInterface()
 
     def run(self, *args, **kwargs):
@@ -139,11 +185,13 @@ class VMSetup:
             # trying to more accurately reflect what the exact command line script would be, 
             # which could be copy+pasted directly in and wrapped with this function.
             cmd(f'git clone {self.github_repo}')
+
+            # arguments are split with shell quoting rules, so quoted args and paths survive:
+            cmd('git commit -m "initial commit"')
         
             # however, the longer form, split apart args version self.cli.run([]) is recommended for better accuracy.
         """
-        args = command.split(' ')
-        self.cli.run(args)
+        self.cli.run(list(_tokenize(command)))
         return
     
     
@@ -154,39 +202,101 @@ class VMSetup:
         print("NOTE: GitHub Personal Access Tokens (PAT) can only be used with HTTPS, not SSH")
         print("See: https://docs.github.com/en/authentication/keeping-your-account-and-data-secure/managing-your-personal-access-tokens")
 
-        # Clone repository
-        h2(f"\nCloning repository: {self.github_repo}")
-        self.run(['git', 'clone', self.github_repo])
-
-        # Configure Git globally
-        h2("\nConfiguring Git user settings...")
-        self.run(['git', 'config', '--global', 'user.email', self.email])
-        self.run(['git', 'config', '--global', 'user.name', 'Ralph Wiggum'])
+        self.cli.run_script(self.git_commands())
 
         h2("✓ Git configuration complete")
+
+    def git_commands(self) -> List[Command]:
+        """Commands to clone the repository and configure Git."""
+        return [
+            # Clone repository
+            ['echo', f"Cloning repository: {self.github_repo}"],
+            ['git', 'clone', self.github_repo],
+
+            # Configure Git globally
+            ['echo', "Configuring Git user settings..."],
+            ['git', 'config', '--global', 'user.email', self.email],
+            ['git', 'config', '--global', 'user.name', 'Ralph Wiggum'],
+        ]
     
     def setup_nodejs(self):
-        """Install Node.js and npm."""
+        """Add the Node.js 20.x package repository."""
         title(VMSetup.setup_nodejs.__doc__)
 
-        # Make setup.sh executable (if it exists)
-        if Path('setup.sh').exists():
-            self.run(['sudo', 'chmod', '+x', 'setup.sh'])
+        self.cli.run_script(self.nodejs_commands())
 
-        # Install Node.js
-        h2("Installing Node.js 20.x...")
-        self.run(
-            'curl -fsSL https://deb.nodesource.com/setup_20.x | sudo -E bash -',
-            shell=True
-        )
-        self.run(['sudo', 'apt-get', 'install', '-y', 'nodejs'])
+    def nodejs_commands(self) -> List[Command]:
+        """Commands to add the NodeSource repository (installed by install_packages)."""
+        return [
+            # Make setup.sh executable (if it exists); checked by the script
+            # itself so no separate stat is needed up front
+            'if [ -f setup.sh ]; then sudo chmod +x setup.sh; fi',
 
-        # Verify installation
-        result = self.run(['node', '--version'])
-        print(f"✓ Node.js installed: {result.stdout.strip()}")
+            ['echo', "Adding Node.js 20.x repository..."],
+            self.nodesource_setup_command(),
+        ]
 
-        result = self.run(['npm', '--version'])
-        print(f"✓ npm installed: {result.stdout.strip()}")
+    def nodesource_setup_command(self) -> str:
+        """
+        Shell snippet that runs the NodeSource setup script only if its apt source is missing.
+
+        The script is downloaded to a temp file and only moved into the cache
+        (reused on re-runs) once curl succeeds and, when nodesource_sha256 is
+        set, the hash matches. A cached copy is re-verified before it is run with sudo.
+        """
+        cache = shlex.quote(str(self.NODESOURCE_SETUP_CACHE))
+
+        def verify(path: str, indent: str) -> List[str]:
+            if not self.nodesource_sha256:
+                return []
+            return [
+                f'{indent}if ! echo {shlex.quote(self.nodesource_sha256)}"  "{path} | sha256sum -c --quiet -; then',
+                f'{indent}    rm -f {path}',
+                f'{indent}    echo "NodeSource setup script failed SHA-256 verification" >&2',
+                f'{indent}    exit 1',
+                f'{indent}fi',
+            ]
+
+        return '\n'.join([
+            f'if [ -f {self.NODESOURCE_APT_SOURCE} ]; then',
+            '    echo "✓ NodeSource repository already configured"',
+            'else',
+            f'    if [ ! -s {cache} ]; then',
+            f'        mkdir -p "$(dirname {cache})"',
+            f'        nodesource_tmp=$(mktemp {cache}.XXXXXX)',
+            f'        if ! curl -fsSL -o "$nodesource_tmp" {shlex.quote(self.NODESOURCE_SETUP_URL)}; then',
+            '            rm -f "$nodesource_tmp"',
+            '            exit 1',
+            '        fi',
+            *verify('"$nodesource_tmp"', '        '),
+            f'        mv "$nodesource_tmp" {cache}',
+            *(['    else', *verify(cache, '        ')] if self.nodesource_sha256 else []),
+            '    fi',
+            f'    sudo -E bash {cache}',
+            'fi',
+        ])
+
+    def install_packages(self):
+        """Install Node.js, npm and GitHub CLI."""
+        title(VMSetup.install_packages.__doc__)
+
+        self.cli.run_script(self.package_commands())
+
+    def package_commands(self) -> List[Command]:
+        """Commands to install all apt packages in one apt-get run."""
+        return [
+            ['echo', f"Installing {', '.join(self.APT_PACKAGES)}..."],
+            ['sudo', 'apt-get', 'install', '-y', *self.APT_PACKAGES],
+
+            # Verify installation; plain assignments so `bash -e` stops if a
+            # command is missing (a failing $(...) inside echo's args would not)
+            'node_version=$(node --version)',
+            'echo "✓ Node.js installed: $node_version"',
+            'npm_version=$(npm --version)',
+            'echo "✓ npm installed: $npm_version"',
+            'gh_version=$(gh --version)',
+            'echo "✓ GitHub CLI installed: $(head -n 1 <<< "$gh_version")"',
+        ]
 
     def setup_api_key(self):
         """Configure OpenRouter API key."""
@@ -199,8 +309,18 @@ class VMSetup:
         bashrc_path = Path.home() / '.bashrc'
         export_line = f'export OPENROUTER_API_KEY="{self.api_key}"\n'
 
+        try:
+            existing = bashrc_path.read_text()
+        except FileNotFoundError:
+            existing = ''
+
+        if export_line in existing:
+            print("✓ API key configured (already in .bashrc)")
+            return
+
+        payload = f'\n# Added by VM setup script\n{export_line}'
         with open(bashrc_path, 'a') as f:
-            f.write(f'\n# Added by VM setup script\n{export_line}')
+            f.write(payload)
 
         print("✓ API key configured and added to .bashrc")
 
@@ -208,21 +328,30 @@ class VMSetup:
         """Install Playwright and its dependencies."""
         title(VMSetup.setup_playwright.__doc__)
 
-        h2("Installing Playwright dependencies...")
-        self.run(['npx', 'playwright', 'install-deps'])
-
-        h2("Installing Playwright browsers...")
-        self.run(['npx', 'playwright', 'install'])
+        self.cli.run_script(
+            self.playwright_deps_commands() + self.playwright_browser_commands()
+        )
 
         print("✓ Playwright installation complete")
 
+    def playwright_deps_commands(self) -> List[Command]:
+        """Commands to install Playwright's system dependencies (uses apt)."""
+        return [
+            ['echo', "Installing Playwright dependencies..."],
+            ['npx', 'playwright', 'install-deps', *self.PLAYWRIGHT_BROWSERS],
+        ]
+
+    def playwright_browser_commands(self) -> List[Command]:
+        """Commands to download the Playwright browsers (a no-op if the required revision is cached)."""
+        return [
+            ['echo', "Installing Playwright browsers..."],
+            ['npx', 'playwright', 'install', *self.PLAYWRIGHT_BROWSERS],
+        ]
+
     def setup_github_cli(self):
-        """Install and configure GitHub CLI."""
+        """Configure GitHub CLI (installed by install_packages)."""
         title(VMSetup.setup_github_cli.__doc__)
 
-        h2("Installing GitHub CLI...")
-        self.run(['sudo', 'apt-get', 'install', '-y', 'gh'])
-
         title("MANUAL STEP REQUIRED: GitHub CLI Authentication")
 
         print("\nPlease run the following command manually and follow the prompts:")
@@ -257,19 +386,19 @@ class VMSetup:
 
         pub_key_path = Path.home() / '.ssh' / 'id_ed25519.pub'
 
-        if pub_key_path.exists():
-            with open(pub_key_path, 'r') as f:
-                pub_key = f.read().strip()
-
-            title("SSH Public Key Generated")
-            print(f"\nYour public key:\n{pub_key}\n")
-            print("Please add this key to your GitHub account:")
-            print("  https://github.com/settings/keys")
-            print("\nNote: The 'gh ssh-key add' command currently fails with:")
-            print("  'HTTP 403: Resource not accessible by personal access token'")
-            print("TODO: Fix automated SSH key addition via gh CLI\n")
-        else:
+        try:
+            pub_key = pub_key_path.read_text().strip()
+        except FileNotFoundError:
             print("SSH key file not found after generation")
+            return
+
+        title("SSH Public Key Generated")
+        print(f"\nYour public key:\n{pub_key}\n")
+        print("Please add this key to your GitHub account:")
+        print("  https://github.com/settings/keys")
+        print("\nNote: The 'gh ssh-key add' command currently fails with:")
+        print("  'HTTP 403: Resource not accessible by personal access token'")
+        print("TODO: Fix automated SSH key addition via gh CLI\n")
 
     def sync_repository(self, repo_name: str):
         """Fetch, pull, and push repository changes."""
@@ -313,11 +442,19 @@ class VMSetup:
         print("="*70)
         
         try:
+            self.setup_api_key()
+
+            # Each step runs its commands as one batched script. Steps run in
+            # order: the HTTPS clone can prompt for credentials and the
+            # NodeSource/apt steps for a sudo password, so they must not
+            # share the terminal at the same time.
             self.clone_and_configure_git()
             self.setup_nodejs()
-            self.setup_api_key()
+            self.install_packages()
             self.setup_playwright()
             self.setup_github_cli()
+
+            # Interactive steps stay separate so the user can see the prompts
             self.setup_ssh_keys()
             
             # Extract repo name from URL
@@ -345,6 +482,7 @@ class VMSetup:
         EMAIL = os.getenv('GIT_EMAIL', '{{your-masked-github-email-here@users.noreply.github.com}}')
         API_KEY = os.getenv('OPENROUTER_API_KEY', '{{inject-your-key-here-do-not-hardcode}}')
         PROJECT_REPO = os.getenv('PROJECT_REPO', '')
+        NODESOURCE_SHA256 = os.getenv('NODESOURCE_SETUP_SHA256', '')
         
         # Validate configuration
         if '{{' in EMAIL or '{{' in API_KEY:
@@ -360,7 +498,8 @@ class VMSetup:
             github_repo=GITHUB_REPO,
             email=EMAIL,
             api_key=API_KEY,
-            project_repo=PROJECT_REPO
+            project_repo=PROJECT_REPO,
+            nodesource_sha256=NODESOURCE_SHA256
         )
 
 
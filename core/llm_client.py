@@ -6,13 +6,41 @@ This module contains functions for calling LLM APIs with proper timeout handling
 retry logic, and response validation.
 """
 
-import re
 import json
+import random
 import time
 import requests
-import os
 import click
 from typing import List, Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Shared session so keep-alive connections and TLS sessions are reused across
+# retries instead of handshaking with OpenRouter on every attempt.
+# Retries are handled by call_llm_with_timeout_handling, not by the adapter.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
+
+# Trailing characters that suggest the response was cut off mid-structure
+_INCOMPLETE_TAIL = frozenset('},:"[{')
+
+_DECODER = json.JSONDecoder()
+
+# Small enough that the deadline is checked while the body is still arriving:
+# each read blocks until this many bytes (or the end of the body) are in
+_STREAM_CHUNK_SIZE = 1024
+
+# Exponential backoff between retries: min(cap, base * 2**attempt) plus up to
+# 1s of jitter. Retry-After on 429/503 overrides it, up to _RETRY_AFTER_CAP.
+_BACKOFF_BASE = 0.5
+_BACKOFF_CAP = 30
+_RETRY_AFTER_CAP = 120
+_RETRY_AFTER_STATUSES = frozenset({429, 503})
+
+# 4xx responses that may succeed on retry; any other 4xx (bad key, bad request)
+# fails immediately instead of burning the remaining attempts
+_RETRYABLE_CLIENT_ERRORS = frozenset({408, 429})
 
 def is_llm_response_incomplete(response_text: str) -> bool:
     """
@@ -21,32 +49,86 @@ def is_llm_response_incomplete(response_text: str) -> bool:
     if not response_text:
         return True
 
-    # Check for incomplete JSON
+    stripped = response_text.strip()
+
+    # Check for complete JSON: one or more back-to-back JSON values that
+    # consume the whole response (e.g. multi-object streamed output)
     try:
-        json.loads(response_text)
-        return False  # Valid JSON
+        end = 0
+        while end < len(stripped):
+            _, end = _DECODER.raw_decode(stripped, end)
+            while end < len(stripped) and stripped[end].isspace():
+                end += 1
+        if stripped:
+            return False  # Valid JSON
     except json.JSONDecodeError:
         pass
 
-    # Check for common incomplete patterns
-    incomplete_patterns = [
-        r'}\s*$',  # Ends with closing brace but might be incomplete
-        r',\s*$',  # Ends with comma
-        r':\s*$',  # Ends with colon
-        r'"\s*$',  # Ends with quote
-        r'\[\s*$',  # Ends with opening bracket
-        r'{\s*$',  # Ends with opening brace
-    ]
+    # Check if response is very short (likely incomplete)
+    if len(stripped) < 50:
+        return True
 
-    for pattern in incomplete_patterns:
-        if re.search(pattern, response_text.strip()):
-            return True
+    # Check for common incomplete endings (closing brace, comma, colon,
+    # quote, or an opening bracket/brace)
+    return stripped[-1] in _INCOMPLETE_TAIL
 
-    # Check if response is very short (likely incomplete)
-    if len(response_text.strip()) < 50:
+def _read_response_body(response: requests.Response, deadline: float) -> bytearray:
+    """
+    Read a streamed response body, aborting once the overall deadline passes.
+
+    With stream=True the requests timeout only bounds each socket read, so a
+    slowly trickling body could otherwise run far past the caller's timeout.
+    A body that has fully arrived is kept even if it finished after the deadline.
+    """
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=_STREAM_CHUNK_SIZE):
+        body += chunk
+        if time.monotonic() > deadline and not _body_received(response, body):
+            raise requests.exceptions.Timeout("Response body not received before timeout")
+    return body
+
+def _body_received(response: requests.Response, body: bytearray) -> bool:
+    """
+    Check whether the whole response body has been read.
+    """
+    remaining = response.raw.length_remaining
+    if remaining is not None:
+        return remaining == 0  # Content-Length fully read
+    # Chunked transfer: the length is unknown, so accept a body that already parses
+    try:
+        json.loads(bytes(body))
         return True
+    except ValueError:
+        return False
+
+def _backoff_delay(attempt: int) -> float:
+    """
+    Seconds to wait after a failed attempt (0-based), with jitter.
+    """
+    return min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt) + random.random()
+
+def _retry_after_delay(response: Optional[requests.Response]) -> Optional[float]:
+    """
+    Seconds requested by a 429/503 Retry-After header, or None if absent/unparseable.
+    """
+    if response is None or response.status_code not in _RETRY_AFTER_STATUSES:
+        return None
+    try:
+        return min(_RETRY_AFTER_CAP, max(0.0, float(response.headers.get("Retry-After"))))
+    except (TypeError, ValueError):
+        return None  # Missing, or an HTTP-date (falls back to backoff)
 
-    return False
+def _error_detail(response: requests.Response) -> str:
+    """
+    Error message from a failed response body (OpenRouter's error.message, or the raw text).
+    """
+    try:
+        message = response.json()["error"]["message"]
+        if isinstance(message, str) and message:
+            return message
+    except (ValueError, KeyError, TypeError):
+        pass
+    return response.text.strip()[:500]
 
 def call_llm_with_timeout_handling(
     api_key: str,
@@ -65,20 +147,41 @@ def call_llm_with_timeout_handling(
         "messages": messages,
         "max_tokens": 4000,  # Limit response size to reduce timeout risk
     }
+    # Encode once up front rather than re-serializing the payload on every retry
+    body = json.dumps(payload).encode("utf-8")
 
+    delay = 0.0
+    last_error = None
     for attempt in range(max_retries):
+        if attempt > 0:
+            time.sleep(delay)
+        delay = _backoff_delay(attempt)
+
+        error_detail = ""
         try:
             print(f"LLM API call attempt {attempt + 1}/{max_retries}")
 
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
+            # Deadline covers waiting for headers as well as reading the body
+            deadline = time.monotonic() + timeout
+            with _SESSION.post(
+                OPENROUTER_URL,
                 headers=headers,
-                json=payload,
-                timeout=timeout
-            )
-            response.raise_for_status()
-
-            result = response.json()
+                data=body,
+                timeout=timeout,
+                stream=True
+            ) as response:
+                if not response.ok:
+                    # Read the error body while the streamed response is still open
+                    error_detail = _error_detail(response)
+                response.raise_for_status()
+                response_body = _read_response_body(response, deadline)
+
+            try:
+                result = json.loads(bytes(response_body))
+            except ValueError:  # JSONDecodeError, or UnicodeDecodeError on non-UTF-8 bytes
+                print(f"Response body was not valid JSON on attempt {attempt + 1}, retrying...")
+                last_error = f"invalid response body: {bytes(response_body[:200])!r}"
+                continue
 
             # Check if response is complete
             if "choices" in result and len(result["choices"]) > 0:
@@ -86,24 +189,45 @@ def call_llm_with_timeout_handling(
 
                 if is_llm_response_incomplete(content):
                     print(f"Response appears incomplete on attempt {attempt + 1}, retrying...")
-                    time.sleep(2)  # Brief pause before retry
+                    last_error = "incomplete response"
                     continue
 
                 return result
 
-        except requests.exceptions.Timeout:
+            # OpenRouter can report errors in a 200 response with no choices
+            error = result.get("error") if isinstance(result, dict) else None
+            if isinstance(error, dict):
+                error = error.get("message") or error
+            print(f"LLM API returned no choices on attempt {attempt + 1}: {error}")
+            last_error = error or "response without choices"
+
+        except requests.exceptions.Timeout as e:
             print(f"LLM API call timed out on attempt {attempt + 1}")
+            last_error = e
+            continue
+        except requests.exceptions.HTTPError as e:
+            message = f"{e}: {error_detail}" if error_detail else str(e)
+            last_error = message
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and 400 <= status < 500 and status not in _RETRYABLE_CLIENT_ERRORS:
+                click.echo(f"LLM API request rejected with HTTP {status}, not retrying: {message}", err=True)
+                return None
+            print(f"LLM API call failed on attempt {attempt + 1}: {message}")
+            retry_after = _retry_after_delay(e.response)
+            if retry_after is not None:
+                delay = retry_after
             continue
         except requests.exceptions.RequestException as e:
             print(f"LLM API call failed on attempt {attempt + 1}: {e}")
+            last_error = e
             continue
 
-    print("All LLM API attempts failed or returned incomplete responses")
+    print(f"All LLM API attempts failed or returned incomplete responses (last error: {last_error})")
     return None
 
 
 @click.command()
-@click.option('--api-key', default=lambda: os.environ.get('OPENROUTER_API_KEY'), help='API key for OpenRouter (defaults to OPENROUTER_API_KEY env var)')
+@click.option('--api-key', envvar='OPENROUTER_API_KEY', help='API key for OpenRouter (defaults to OPENROUTER_API_KEY env var)')
 @click.argument('query', required=True)
 @click.option('--model', default='anthropic/claude-3-haiku:beta', help='Model to use (default: best free coding model)')
 @click.option('--timeout', default=120, type=int, help='Timeout in seconds (default: 120)')
@@ -113,7 +237,8 @@ def main(api_key, query, model, timeout):
     if not query.strip():
         raise click.ClickException("Query cannot be blank.")
     messages = [{"role": "user", "content": query}]
-    result = call_llm_with_timeout_handling(api_key, model, messages, timeout=timeout)
+    with _SESSION:
+        result = call_llm_with_timeout_handling(api_key, model, messages, timeout=timeout)
     if result and "choices" in result and len(result["choices"]) > 0:
         click.echo(result["choices"][0]["message"]["content"])
     else: